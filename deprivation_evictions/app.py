@@ -1,35 +1,120 @@
 # Code to create the dashboard
 # Built and edited by Stephania Tello Zamudio and Andrew Dunn
 
+import gzip
+import os
+import numpy as np
 import pandas as pd
 from urllib.request import urlopen
-import json
+import orjson
+from shapely.geometry import mapping, shape
+import plotly.io as pio
 from dash import Dash, dcc, html, Input, Output
 import dash_bootstrap_components as dbc
 
 # Import the graphs
 from .graphs.bivariate_map import bivariate_map, create_legend
 from .graphs.scatter_plot import make_scatter_plot
-from .graphs.radar_graph import create_radar_graph
+from .graphs.radar_graph import RADAR_COLS, prepare_radar_data, create_radar_graph
 from .graphs.general_map import general_map
 
-# Load the processed data
-df = pd.read_csv('deprivation_evictions/data_bases/final_data/processed_data.csv')
+# Load the processed data (only the columns used by the graphs)
+use_cols = ['zipcode', 'eviction_filings_completed', 'eviction_filings_completed_scaled',
+            'g1_sum_scaled'] + RADAR_COLS
+df = pd.read_parquet('deprivation_evictions/data_bases/final_data/processed_data.parquet',
+                     columns=use_cols)
 
 # Do final edits to the data for the visualizations
 df = df.sort_values('zipcode')
+# The parquet stores float32, round in float64 so the 3 decimals stay exact
+df = df.astype({col: np.float64 for col in df.select_dtypes('float32').columns})
 df = df.round(3)
 
 # Boundaries by Zip code - Chicago (Geojson)
 boundaries_url = "https://data.cityofchicago.org/api/geospatial/gdcf-axmw?method=export&format=GeoJSON"
+# Simplification tolerance (degrees) and decimals kept in the coordinates; the
+# cache file is named after them so changing either one rebuilds it
+simplify_tolerance = 0.0005
+coord_digits = 5
+boundaries_cache = "deprivation_evictions/data_bases/cache/zipcodes_s{}_r{}.json.gz".format(
+    simplify_tolerance, coord_digits)
 
-with urlopen(boundaries_url) as response:
-    zipcodes = json.load(response)
+
+def round_coordinates(coords, ndigits=5):
+    '''
+    Rounds a (nested) list of GeoJSON coordinates
+
+    Inputs:
+        coords (list or float): coordinates of a geometry
+        ndigits (int): number of decimals to keep
+
+    Returns: (list or float) rounded coordinates
+    '''
+    if isinstance(coords, (int, float)):
+        return round(coords, ndigits)
+    return [round_coordinates(c, ndigits) for c in coords]
+
+
+def load_zipcodes():
+    '''
+    Loads the zip code boundaries of Chicago. The boundaries are only
+    downloaded when there is no local copy for the current simplify_tolerance
+    and coord_digits; in that case the polygons are simplified, their
+    precision reduced and the result cached on disk.
+
+    Returns: (dict) geojson with the zip code boundaries
+    '''
+    if os.path.exists(boundaries_cache):
+        with gzip.open(boundaries_cache, 'rb') as f:
+            return orjson.loads(f.read())
+
+    with urlopen(boundaries_url) as response:
+        zipcodes = orjson.loads(response.read())
+
+    # Keep only what the maps need: a coarse polygon and the zip code
+    for feature in zipcodes['features']:
+        geometry = shape(feature['geometry']).simplify(simplify_tolerance, preserve_topology=True)
+        geometry = mapping(geometry)
+        feature['geometry'] = {'type': geometry['type'],
+                               'coordinates': round_coordinates(geometry['coordinates'], coord_digits)}
+        feature['properties'] = {'zip': feature['properties']['zip']}
+
+    os.makedirs(os.path.dirname(boundaries_cache), exist_ok=True)
+    with gzip.open(boundaries_cache, 'wb') as f:
+        f.write(orjson.dumps(zipcodes))
+
+    return zipcodes
+
+
+zipcodes = load_zipcodes()
 
 app = Dash(__name__, external_stylesheets=[dbc.themes.FLATLY])
 
+# Serialize figures (done by Dash on every callback) with orjson
+pio.json.config.default_engine = 'orjson'
+
+
+def serialize_figure(fig):
+    '''
+    Converts a figure into plain JSON data, so it doesn't have to be
+    validated and converted again every time a callback returns it
+
+    Inputs:
+        fig (plotly figure)
+
+    Returns: (dict) the figure as JSON data
+    '''
+    return orjson.loads(fig.to_json())
+
+
+# Every interactive graph only depends on a small, fixed set of inputs, so all
+# the figures are built once here and the callbacks just look them up
+
 # ----------------- GENERAL MAP -----------------------
-gen_map = general_map(df, 'Evictions per capita', zipcodes)
+map_options = ["Evictions per capita", "Deprivation Index"]
+gen_map_figs = {ind_evic: serialize_figure(general_map(df, ind_evic, zipcodes))
+                for ind_evic in map_options}
+gen_map = gen_map_figs['Evictions per capita']
 
 # ----------------- BIVARIATE MAP ---------------------
 colors = ['rgb(222, 224, 210)', 'rgb(189, 206, 181)', 'rgb(153, 189, 156)', 
@@ -40,21 +125,29 @@ map_fig = bivariate_map(df, colors, zipcodes, "Deprivation Index", "Evictions pe
 map_legend = create_legend(colors)
 
 # ----------------- INTERACTIVE SCATTER PLOT ---------------------
-indicator_dropdown = dcc.Dropdown(options = ['Deprivation Index',
-                                             'Violent Crime',
-                                             'Non-Violent Crime', 
-                                             'Rent-to-Income Ratio',
-                                             'Time to the Loop',
-                                             'Distance to the Loop',
-                                             ], value = 'Violent Crime',
-                                             )
+indicator_options = ['Deprivation Index',
+                     'Violent Crime',
+                     'Non-Violent Crime', 
+                     'Rent-to-Income Ratio',
+                     'Time to the Loop',
+                     'Distance to the Loop',
+                     ]
+indicator_dropdown = dcc.Dropdown(options = indicator_options, value = 'Violent Crime')
 
-scatter_fig = make_scatter_plot(df, 'Deprivation Index')
+scatter_figs = {x_var: serialize_figure(make_scatter_plot(df, x_var))
+                for x_var in indicator_options}
+scatter_fig = scatter_figs['Deprivation Index']
 
 
 # ----------------- INTERACTIVE RADAR PLOT ---------------------
-zip_dropdown = dcc.Dropdown(options = df['zipcode'].unique(), value = '60601')
-radar_fig = create_radar_graph(df, 60615, 'zipcode')
+# df is sorted by zipcode, so the unique zip codes come out in order
+zips = df['zipcode'].drop_duplicates().tolist()
+zip_dropdown = dcc.Dropdown(options = [{'label': str(z), 'value': z} for z in zips],
+                            value = 60601)
+radar_data = prepare_radar_data(df, 'zipcode')
+radar_figs = {zip_code: serialize_figure(create_radar_graph(radar_data, zip_code))
+              for zip_code in radar_data['zip_idx']}
+radar_fig = radar_figs[60615]
 
 # ----------------- APP LAYOUT ------------------------
 
@@ -101,7 +194,7 @@ app.layout = dbc.Container(
             )
         ),
         dbc.Row(dbc.RadioItems(id = 'ind_evic', 
-                               options = ["Evictions per capita", "Deprivation Index"],
+                               options = map_options,
                                value = "Evictions per capita",
                                inline = True)
         ),
@@ -204,7 +297,7 @@ app.layout = dbc.Container(
         Input(component_id='ind_evic', component_property= 'value')
 )
 def update_graph(ind_evic):
-    return general_map(df, ind_evic, zipcodes)
+    return gen_map_figs[ind_evic]
 
 # Dropdown for radar graph
 @app.callback(
@@ -212,8 +305,7 @@ def update_graph(ind_evic):
     Input(component_id = zip_dropdown, component_property = 'value')
 )
 def update_graph(selected_zip):
-    selected_zip = int(selected_zip)
-    return create_radar_graph(df, selected_zip, 'zipcode')
+    return radar_figs[selected_zip]
 
 # Dropdown for scatter plot
 @app.callback(
@@ -221,7 +313,7 @@ def update_graph(selected_zip):
     Input(component_id = indicator_dropdown, component_property = 'value')
 )
 def update_graph(selected_x_var):
-    return make_scatter_plot(df, selected_x_var)
+    return scatter_figs[selected_x_var]
 
 
 if __name__ == '__main__':
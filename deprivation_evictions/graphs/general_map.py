@@ -33,6 +33,8 @@ def general_map(df, ind_evic, geojson):
     fig.update_geos(fitbounds='locations', visible=False)
 
     fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0},
-                      coloraxis_showscale=True)
+                      coloraxis_showscale=True,
+                      # keep the zoom and position when switching variables
+                      uirevision='keep')
 
     return fig
\ No newline at end of file
@@ -1,49 +1,61 @@
 # Creates a radar graph to compare kay variables of a zip code against the mean
 # Written by Andrew Dunn
 
+import numpy as np
 import pandas as pd
 from dash import Dash, dcc, html
 import plotly.express as px
 import plotly.graph_objects as go
 
-def create_radar_graph(df, zip_code, zipcode_col_name):
+# Radar indicators and their labels, in order
+RADAR_COLS = ['violent_crime_norm', 'non_offensive_crime_norm', 'RTI_ratio_norm',
+              'time_to_CBD_norm', 'distance_to_CBD_norm']
+CATEGORIES = ['Violent Crime', 'Non-Violent Crime',
+              'Rent-to-Income Ratio', 'Time to Loop', 'Distance to Loop']
+
+def prepare_radar_data(df, zipcode_col_name):
     '''
-    Creates a plotly radar graph
+    Precomputes everything the radar graph needs that does not depend on the
+    selected zip code, so it is only done once
 
     Inputs:
         df (pandas dataframe)
-        zip_code (int): the zip code to use in the graph
         zipcode_col_name (str): the name of the relevant zip code col in the df
-    
+
     Returns:
-        fig (plotly figure): the radar plot of a zip vs the average
+        radar_data (dict): with keys
+            values (numpy array): the radar indicators, one row per zip code
+            zip_idx (dict): maps each zip code to its row in values
+            city_means (numpy array): the city-wide mean of each indicator
+            axis_range (list): the minimum and maximum over all indicators
     '''
+    # Summaries in float64, only the per zip code rows are kept in float32
+    values = df[RADAR_COLS].to_numpy(dtype=np.float64)
+    zip_idx = {int(zip_code): i for i, zip_code in enumerate(df[zipcode_col_name])}
 
-    # Format zip code column correctly
-    df = df.set_index(zipcode_col_name)
-
-    # Get the data in the right format
-    zip_dict = {}
+    return {'values': values.astype(np.float32),
+            'zip_idx': zip_idx,
+            'city_means': values.mean(axis=0),
+            'axis_range': [float(values.min()), float(values.max())]}
 
-    for index, rows in df.iterrows():
-        zip_dict[index] = [rows.violent_crime_norm,
-                           rows.non_offensive_crime_norm, rows.RTI_ratio_norm, 
-                           rows.time_to_CBD_norm, rows.distance_to_CBD_norm]
+def create_radar_graph(radar_data, zip_code):
+    '''
+    Creates a plotly radar graph
 
-    # Define the data labels, in order
-    categories = ['Violent Crime', 'Non-Violent Crime', 
-                  'Rent-to-Income Ratio', 'Time to Loop', 'Distance to Loop']
+    Inputs:
+        radar_data (dict): the output of prepare_radar_data
+        zip_code (int): the zip code to use in the graph
+    
+    Returns:
+        fig (plotly figure): the radar plot of a zip vs the average
+    '''
 
     fig = go.Figure()   
 
     # Graph the city averages
     fig.add_trace(go.Scatterpolar(
-        r = [df['violent_crime_norm'].mean(axis=0), 
-                df['non_offensive_crime_norm'].mean(axis=0), 
-                df['RTI_ratio_norm'].mean(axis=0),
-                df['time_to_CBD_norm'].mean(axis=0),
-                df['distance_to_CBD_norm'].mean(axis=0)],
-        theta = categories,
+        r = radar_data['city_means'],
+        theta = CATEGORIES,
         fill = 'toself',
         name = 'City-wide mean',
         fillcolor = 'rgb(65, 157, 129)',
@@ -52,31 +64,21 @@ def create_radar_graph(df, zip_code, zipcode_col_name):
 
     # Create the graph for a specific zip code
     fig.add_trace(go.Scatterpolar(
-        r = zip_dict[zip_code],
-        theta = categories,
+        r = radar_data['values'][radar_data['zip_idx'][zip_code]],
+        theta = CATEGORIES,
         fill = 'toself',
         name = "Zip code = {}".format(zip_code),
         fillcolor = 'rgb(28, 72, 93)',
         line_color = 'rgb(28, 72, 93)'
     ))
 
-    # Get maximum value for the different axes
-
-    indicators = ['violent_crime_norm', 
-                'non_offensive_crime_norm', 'RTI_ratio_norm', 
-                'time_to_CBD_norm', 'distance_to_CBD_norm']
-    
-    maxes = df[indicators].max(axis=0)
-    
-    mins = df[indicators].min(axis=0)
-
     # Add ranges to the graph
     fig.update_layout(
         polar=dict(
             radialaxis=dict(
             visible=True,
-            range=[mins.min(), maxes.max()]
-            #range=[mins.min(), 3]
+            range=radar_data['axis_range']
+            #range=[radar_data['axis_range'][0], 3]
             )),
         showlegend=True
     )
@@ -1,10 +1,11 @@
 # Constructing a deprivation index following the AF methodology
 # Created by Gregory Ho
 
+import os
+import sys
+from functools import lru_cache
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
-from factor_analyzer import FactorAnalyzer
 
 ### To run, the following parameters are instantiated ###
 
@@ -25,12 +26,108 @@ k = 0
 # 3) path to clean data
 cleaned_data = "deprivation_evictions/data_bases/clean_data/clean_database.csv"
 transport_data = "deprivation_evictions/data_bases/raw_data/google_distancematrix.csv"
-output_path = "deprivation_evictions/data_bases/final_data/processed_data.csv"
+output_path = "deprivation_evictions/data_bases/final_data/processed_data.parquet"
 
 # 4) PCA parameters (This segment is for further analysis, unutilized in our viz)
+#    rotate_fn is either "varimax" or None (unrotated loadings)
+#    n_comp must equal the number of dimensions, since the weighted deprivation
+#    index aggregates one weight per factor over the dimensions
 n_comp = 5
 rotate_fn = "varimax"
 
+# 5) Set to True (or set the MDPI_PLOTS environment variable to e.g. 1) to show
+#    the scree plot and the communalities of the factors retained by the
+#    Kaiser criterion (eigenvalues > 1)
+show_diagnostics = os.getenv('MDPI_PLOTS', '').strip().lower() not in ('', '0', 'false', 'no')
+
+
+def is_up_to_date(output_path, input_paths):
+    '''
+    Checks whether the output file exists and is newer than all its inputs
+
+    Inputs:
+        output_path - path to the output file
+        input_paths - list of paths to the files the output is built from
+    Returns: True if the output does not need to be rebuilt
+    '''
+    if not os.path.exists(output_path):
+        return False
+    last_input = max(os.path.getmtime(path) for path in input_paths)
+    return os.path.getmtime(output_path) > last_input
+
+
+@lru_cache(maxsize=None)
+def load_travel_data(transport_data):
+    '''
+    Reads the travel times and distances to the CBD and averages them by 
+    zipcode. The result is cached, so each file is only read once.
+
+    Input: path to the travel data (google distance matrix)
+    Returns: pandas dataframe indexed by (sorted) zipcode
+    '''
+    travel_data = pd.read_csv(transport_data,
+                              usecols=['zipcode', 'time_to_CBD', 'distance_to_CBD'],
+                              dtype={'zipcode': 'int32'})
+    return travel_data.groupby('zipcode').mean()
+
+
+def af_matrices(values, thresholds, k):
+    '''
+    Computes the deprivation matrix y and the normalized gap g^1 of the AF 
+    method together, in one pass over the indicators
+
+    Inputs:
+        values - n x d numpy array of indicators (zipcodes x dimensions)
+        thresholds - numpy array with the d deprivation cutoffs
+        k - fixed cutoff in AF method
+    Returns: Matrix y (uint8) and Matrix g^1(k) (float64) as numpy arrays
+    '''
+    # Binary matrix y, censoring zipcodes with k or less deprivations
+    mat_y = values >= thresholds
+    mat_y[mat_y.sum(axis=1) <= k] = False
+
+    # Normalized gap, with null and negative values replaced by 0 (fmax 
+    # ignores nulls, so both happen in the same pass) and censored with 
+    # matrix y. Operations are done in place to avoid temporary arrays
+    mat_g1 = values - thresholds
+    mat_g1 /= thresholds
+    np.fmax(mat_g1, 0, out=mat_g1)
+    mat_g1 *= mat_y
+
+    return mat_y.astype(np.uint8), mat_g1
+
+
+def varimax(loadings, max_iter=500, tol=1e-5):
+    '''
+    Varimax rotation (with Kaiser normalization) of a matrix of factor loadings
+
+    Inputs:
+        loadings - d x n_comp numpy array of factor loadings
+        max_iter, tol - stopping criteria of the iterations
+    Returns: rotated loadings as a numpy array
+    '''
+    n_rows, n_cols = loadings.shape
+    if n_cols < 2:
+        return loadings
+
+    # Kaiser normalization
+    norms = np.sqrt((loadings ** 2).sum(axis=1, keepdims=True))
+    mat = loadings / norms
+
+    rotation = np.eye(n_cols)
+    crit = 0
+    for _ in range(max_iter):
+        old_crit = crit
+        basis = mat @ rotation
+        target = basis ** 3 - basis * (basis ** 2).sum(axis=0) / n_rows
+        u, sing_vals, vt = np.linalg.svd(mat.T @ target)
+        rotation = u @ vt
+        crit = sing_vals.sum()
+        if crit < old_crit * (1 + tol):
+            break
+
+    return (mat @ rotation) * norms
+
 
 class MultiDimensionalDeprivation:
     def __init__(self, k, cleaned_data, thresholds):
@@ -41,6 +138,13 @@ class MultiDimensionalDeprivation:
         self.data = pd.read_csv(cleaned_data)
         self.thresholds = thresholds
         self.indicators = list(thresholds.keys())
+        self._thr_vec = np.array([self.thresholds[ind] for ind in self.indicators],
+                                 dtype=np.float64)
+
+        # Cached intermediate results, so that each stage is only computed once
+        self._merged = None
+        self._mat_y = None
+        self._g1 = None
 
     def compute_ratios(self):
         '''
@@ -52,15 +156,23 @@ class MultiDimensionalDeprivation:
         Returns:
         extended_data   : processed data in the form of a pandas dataframe
         '''
+        if self._merged is not None:
+            return self._merged
+
         cleaned_data = self.data
-        travel_data = pd.read_csv(transport_data)
-        travel_data = travel_data.groupby('zipcode')[['time_to_CBD', 'distance_to_CBD']].mean()
+        travel_data = load_travel_data(transport_data)
 
         # Compute intermediate values
         cleaned_data["RTI_ratio"] = cleaned_data["RentPrice"]/(cleaned_data["hh_median_income"]/12)
         # [KIV]
         cleaned_data = cleaned_data.rename(columns={'zip_code': 'zipcode'})
-        merged_data = pd.merge(cleaned_data, travel_data, on='zipcode', how='inner')
+        cleaned_data['zipcode'] = cleaned_data['zipcode'].astype('int32')
+
+        # Join on sorted zipcode indexes on both sides
+        cleaned_data = cleaned_data.sort_values('zipcode').set_index('zipcode')
+        merged_data = cleaned_data.join(travel_data, how='inner')
+
+        self._merged = merged_data
         return merged_data
 
     def raw_normalized_viz(self):
@@ -70,19 +182,38 @@ class MultiDimensionalDeprivation:
         Input: merged_data
         Returns: matrix Y in normalized form
         '''
-        mat_y_norm = self.compute_ratios()
+        merged_data = self.compute_ratios()
 
-        for col in mat_y_norm.columns:
-            if col in self.indicators:
-                dim_means = mat_y_norm[col].mean()
-                dim_stds = mat_y_norm[col].std()
-                mat_y_norm[col] =  (mat_y_norm[col] - dim_means) / dim_stds
+        # Standardize all dimensions at once (sample std, skipping nulls as
+        # pandas does)
+        mat_y_norm = merged_data[self.indicators].to_numpy(dtype=np.float64)
+        dim_means = np.nanmean(mat_y_norm, axis=0)
+        dim_stds = np.nanstd(mat_y_norm, axis=0, ddof=1)
+        mat_y_norm = (mat_y_norm - dim_means) / dim_stds
 
-        #filter only columns that were standardized 
-        mat_y_norm = mat_y_norm[[col for col in mat_y_norm.columns if col in self.indicators]]
+        mat_y_norm = pd.DataFrame(mat_y_norm, index=merged_data.index, columns=self.indicators)
 
         return mat_y_norm
         
+    def compute_af_matrices(self):
+        '''
+        Computes (once) the deprivation matrix y and the normalized gap g^1,
+        which share the same pass over the indicators
+
+        Input: merged_data
+        Returns: None, the matrices are stored in the object
+        '''
+        if self._g1 is not None:
+            return None
+
+        merged_data = self.compute_ratios()
+        mat_y, mat_g1 = af_matrices(merged_data[self.indicators].to_numpy(dtype=np.float64),
+                                    self._thr_vec, self.k)
+
+        self._mat_y = pd.DataFrame(mat_y, index=merged_data.index, columns=self.indicators)
+        self._g1 = pd.DataFrame(mat_g1, index=merged_data.index, columns=self.indicators)
+        return None
+
     def deprivation_matrix(self):
         '''
         This function computes a matrix of deprivation scores for n zipcodes (rows)
@@ -93,20 +224,8 @@ class MultiDimensionalDeprivation:
         
         Returns deprivation scores as a pandas dataframe
         '''
-        merged_data = self.compute_ratios()
-
-        #Generate binary matrix y
-        mat_y = pd.DataFrame(index=merged_data.index, columns=self.indicators)
-        merged_data['deprivation_share'] = 0
-        for ind in self.indicators:
-            mat_y[ind] = (merged_data[ind] >= self.thresholds[ind]).astype(int)
-            merged_data['deprivation_share'] += mat_y[ind]
-
-        # for all zipcodes that has less than k deprivations assign all 
-        # elements to be 0 (following AF methodology)
-        mat_y[merged_data['deprivation_share'] <= self.k] = 0
-        
-        return mat_y
+        self.compute_af_matrices()
+        return self._mat_y
 
 
     def normalized_gap(self):
@@ -118,25 +237,28 @@ class MultiDimensionalDeprivation:
         Input: Matrix Y from fn:deprivation_matrix()
         Returns: Matrix g^1(k) as a pandas dataframe
         '''
-        merged_data = self.compute_ratios()
-        mat_y = self.deprivation_matrix()
-        
-        # Compute the normalized gap - each element is expressed in their respective
-        # distance from the deprivation vector (threshold)
-        mat_g1 = pd.DataFrame(index=merged_data.index, columns=self.indicators)
-        for ind in self.indicators:
-            mat_g1[ind] = (merged_data[ind] - self.thresholds[ind]) / self.thresholds[ind]
-        
-        # Replace null and negative values with 0 
-        mat_g1 = mat_g1.fillna(0)
-        mat_g1[mat_g1 < 0] = 0
-        
-        # Apply mat_y to g1
-        for ind in self.indicators:
-            mat_g1[ind] *= mat_y[ind]
+        self.compute_af_matrices()
+        return self._g1
+
+
+    def factor_loadings(self, matrix, n_comp):
+        '''
+        Extracts principal component factors from the correlation matrix
+        using a singular value decomposition of the standardized matrix
+
+        Input: Any Matrix g0, g1, ..., gn (depending on objective of analysis)
+        n_comp - number of factors to keep
+        Returns: eigenvalues of the correlation matrix (all of them) and the
+                 unrotated factor loadings (d x n_comp) as numpy arrays
+        '''
+        mat = matrix.to_numpy(dtype=np.float64)
+        mat = (mat - mat.mean(axis=0)) / mat.std(axis=0, ddof=1)
 
-        return mat_g1
+        _, sing_vals, vt = np.linalg.svd(mat, full_matrices=False)
+        eigenvalues = sing_vals ** 2 / (mat.shape[0] - 1)
+        loadings = vt[:n_comp].T * np.sqrt(eigenvalues[:n_comp])
 
+        return eigenvalues, loadings
 
     def pca_weights(self, matrix, n_comp, rotate_fn):
         '''
@@ -144,34 +266,29 @@ class MultiDimensionalDeprivation:
         eigenvectors of the variance-covariance matrix.
 
         Input: Any Matrix g0, g1, ..., gn (depending on objective of analysis)
-        n_comp equivalent to num of dimensions (default=5 (num dimensions), but 
-        this parameter is should be set based on scree plot and Kaiser criterion)
-        rotate_fn - function for factor rotations (generally: oblimin or varimax)
-        Returns: PCA or Factor weights
+        n_comp - number of factors, must be equal to the num of dimensions
+        (default=5) for fn:weighted_deprivation_inx()
+        rotate_fn - function for factor rotations (varimax or None)
+        Returns: PCA or Factor weights (dimensions x factor_1, ..., factor_n)
         '''
-
-        #PCA
-        pca = PCA()
-        pca.fit(matrix)
-
-        #Generate scree plot
-        plt.plot(range(1, len(pca.explained_variance_)+1),
-        pca.explained_variance_, 'ro-', linewidth=2)
-        plt.title('Scree Plot')
-        plt.xlabel('Principal Component')
-        plt.ylabel('Eigenvalues')
-        plt.show()
+        if rotate_fn not in ("varimax", None):
+            raise ValueError("Unsupported rotation: {}".format(rotate_fn))
+        if n_comp != len(self.indicators):
+            raise ValueError("n_comp must be equal to the number of dimensions "
+                             "({}), got {}".format(len(self.indicators), n_comp))
 
         # Factor analysis - Express factors as rotations
-        fa = FactorAnalyzer(n_factors=n_comp, rotation= rotate_fn)
-        fa.fit(matrix)
-        print(pd.DataFrame(fa.get_communalities(), 
-                           index=matrix.columns, 
-                           columns=['Communalities']))
+        _, weights = self.factor_loadings(matrix, n_comp)
+        if rotate_fn == "varimax":
+            weights = varimax(weights)
+
+        # The sign of each factor is arbitrary (it depends on e.g. the row 
+        # order), fix it so that the loadings of each factor add up positive
+        weights = weights * np.where(weights.sum(axis=0) < 0, -1, 1)
 
         # Express weights as factor loadings
-        weights = fa.loadings_
-        weights = pd.DataFrame(weights, columns=self.indicators)
+        weights = pd.DataFrame(weights, index=self.indicators,
+                               columns=['factor_{}'.format(i + 1) for i in range(n_comp)])
 
         # normalize each row to sum to 1 
         # (For principal components, not needed for factor loadings)
@@ -179,6 +296,45 @@ class MultiDimensionalDeprivation:
         
         return weights
 
+    def diagnostics(self, matrix):
+        '''
+        Shows the scree plot of the correlation matrix and prints the 
+        communalities of the factors retained by the Kaiser criterion
+        (eigenvalues > 1). With all the factors retained every communality
+        is 1, so they are computed on this reduced extraction instead.
+        Rotations do not change the communalities, so none is applied
+
+        Input: Any Matrix g0, g1, ..., gn (same as fn:pca_weights())
+        '''
+        eigenvalues, _ = self.factor_loadings(matrix, matrix.shape[1])
+        self.plot_scree(eigenvalues)
+
+        # Communalities - share of each dimension explained by the factors
+        n_kaiser = max(1, int((eigenvalues > 1).sum()))
+        _, loadings = self.factor_loadings(matrix, n_kaiser)
+        print("Factors retained (eigenvalues > 1): {}".format(n_kaiser))
+        print(pd.DataFrame((loadings ** 2).sum(axis=1), 
+                           index=matrix.columns, 
+                           columns=['Communalities']))
+
+    def plot_scree(self, eigenvalues):
+        '''
+        Shows the scree plot of the eigenvalues of the correlation matrix.
+        matplotlib is only imported here, so the pipeline does not need it
+        (nor a GUI backend) unless the plot is requested
+
+        Input: eigenvalues from fn:factor_loadings()
+        '''
+        import matplotlib.pyplot as plt
+
+        #Generate scree plot
+        plt.plot(range(1, len(eigenvalues)+1),
+        eigenvalues, 'ro-', linewidth=2)
+        plt.title('Scree Plot')
+        plt.xlabel('Principal Component')
+        plt.ylabel('Eigenvalues')
+        plt.show()
+
     def weighted_deprivation_inx(self, matrix, weights):
         '''
         Computes weighted deprivation index for each zipcode
@@ -186,11 +342,11 @@ class MultiDimensionalDeprivation:
         Inputs: 
             matrix  - g0, g1, ..., gn 
             weights - a dataframe containing vectors of weights for 
-                      each dimension
+                      each dimension (one factor per dimension)
         Returns: Weighted deprivation index score for each zipcode 
         '''
-        # Aggregate weights
-        weights = weights.sum(axis=0)
+        # Aggregate weights (one per factor, applied to the dimensions in order)
+        weights = weights.sum(axis=0).to_numpy()
 
         wgt_dpt_idx = matrix.dot(weights)
 
@@ -198,7 +354,7 @@ class MultiDimensionalDeprivation:
         wdi_scaled = (wgt_dpt_idx - wgt_dpt_idx.min()) / (wgt_dpt_idx.max() - wgt_dpt_idx.min())
 
         output_df = pd.DataFrame({'wdi': wgt_dpt_idx,
-                                  'wdi_scaled': wdi_scaled}, index=self.data.index)
+                                  'wdi_scaled': wdi_scaled}, index=matrix.index)
         return output_df
 
     def extend_data(self):
@@ -206,13 +362,16 @@ class MultiDimensionalDeprivation:
         This function extends the processed dataset with the dimensions needed
         to produce our visualizations.
         '''
+        mat_g1 = self.normalized_gap()
+        weights = self.pca_weights(mat_g1, n_comp, rotate_fn)
+        if show_diagnostics:
+            self.diagnostics(mat_g1)
+
         data_extended = (
             self.compute_ratios()
             .join(self.raw_normalized_viz().add_suffix('_norm'))
-            .join(self.normalized_gap().add_suffix('_g1').assign(g1_sum=lambda x: x.sum(axis=1)))
-            .join(self.weighted_deprivation_inx(self.normalized_gap(), 
-                                                self.pca_weights(self.normalized_gap(),
-                                                                 n_comp, rotate_fn)))
+            .join(mat_g1.add_suffix('_g1').assign(g1_sum=lambda x: x.sum(axis=1)))
+            .join(self.weighted_deprivation_inx(mat_g1, weights))
         )
 
         # scale g1_sum using min-max scaling
@@ -220,7 +379,16 @@ class MultiDimensionalDeprivation:
         g1_sum_max = data_extended['g1_sum'].max()
         data_extended['g1_sum_scaled'] = (data_extended['g1_sum'] - g1_sum_min) / (g1_sum_max - g1_sum_min)
 
-        data_extended.to_csv(output_path)
+        data_extended = data_extended.reset_index()
+
+        # Store floats in single precision and integers (counts, zipcode) as 
+        # int32, which halves the size of the output
+        float_cols = data_extended.select_dtypes('float64').columns
+        int_cols = data_extended.select_dtypes('int64').columns
+        data_extended[float_cols] = data_extended[float_cols].astype('float32')
+        data_extended[int_cols] = data_extended[int_cols].astype('int32')
+
+        data_extended.to_parquet(output_path, compression='zstd')
         return None
     
 
@@ -276,5 +444,9 @@ class MultiDimensionalDeprivation:
     
     
 # Includes call to run from command line.
-mdpi = MultiDimensionalDeprivation(k, cleaned_data, thresholds)
-mdpi.extend_data()
\ No newline at end of file
+# The output is only rebuilt if the data or the parameters in this file changed
+# since it was last written; pass --force to rebuild it anyway.
+if "--force" in sys.argv[1:] or not is_up_to_date(output_path,
+                                                 [cleaned_data, transport_data, __file__]):
+    mdpi = MultiDimensionalDeprivation(k, cleaned_data, thresholds)
+    mdpi.extend_data()